@@ -1,11 +1,13 @@
 import signal
 import sys
 
+from xiaozhi.services.discovery import DiscoveryService
 from xiaozhi.xiaoai import XiaoAI
 from xiaozhi.xiaozhi import XiaoZhi
 
 
 def main():
+    DiscoveryService().start()
     XiaoZhi.instance().run()
     return 0
 
@@ -0,0 +1,116 @@
+use aes::Aes128;
+use cmac::Cmac;
+use hmac::{Hmac, Mac};
+use sha2::Sha256;
+use std::time::{SystemTime, UNIX_EPOCH};
+use tokio::net::UdpSocket;
+
+type HmacSha256 = Hmac<Sha256>;
+type CmacAes128 = Cmac<Aes128>;
+
+/// device_id 首字节 0x02 表示 AES-128-CMAC 模式（与 Python 端一致）
+const MAC_AES_CMAC: u8 = 0x02;
+
+/// CMAC 模式用的 16 字节 AES 密钥，从 secret 单步派生（HKDF-Expand）
+fn derive_aes_key(secret: &[u8]) -> [u8; 16] {
+    let mut kdf = HmacSha256::new_from_slice(secret).expect("HMAC 初始化失败");
+    kdf.update(b"open-xiaoai-cmac");
+    kdf.finalize().into_bytes()[..16].try_into().unwrap()
+}
+
+/// 计算 MAC：CMAC 的 16 字节 tag 补零到 32 字节，保持线上格式不变
+fn mac_digest(version: u8, secret: &[u8], aes_key: &[u8; 16], msg: &[u8]) -> [u8; 32] {
+    let mut tag = [0u8; 32];
+    if version == MAC_AES_CMAC {
+        let mut mac = CmacAes128::new_from_slice(aes_key).expect("CMAC 初始化失败");
+        mac.update(msg);
+        tag[..16].copy_from_slice(&mac.finalize().into_bytes());
+    } else {
+        let mut mac = HmacSha256::new_from_slice(secret).expect("HMAC 初始化失败");
+        mac.update(msg);
+        tag.copy_from_slice(&mac.finalize().into_bytes());
+    }
+    tag
+}
+
+/// 校验 MAC（恒定时间比较，补零部分不是秘密可以直接比）
+fn mac_verify(version: u8, secret: &[u8], aes_key: &[u8; 16], msg: &[u8], tag: &[u8]) -> bool {
+    if version == MAC_AES_CMAC {
+        let mut mac = CmacAes128::new_from_slice(aes_key).expect("CMAC 初始化失败");
+        mac.update(msg);
+        mac.verify_truncated_left(&tag[..16]).is_ok() && tag[16..].iter().all(|&b| b == 0)
+    } else {
+        let mut mac = HmacSha256::new_from_slice(secret).expect("HMAC 初始化失败");
+        mac.update(msg);
+        mac.verify_slice(tag).is_ok()
+    }
+}
+
+/// UDP 服务发现（Rust 版）
+///
+/// 协议与 xiaozhi/services/discovery.py 一致：
+/// 请求包（60 字节）: device_id(16) + nonce(4) + timestamp(8) + mac(32)
+/// 应答包（66 字节）: 请求前 28 字节 + ip(4) + ws_port(2) + mac(32)
+pub async fn run(secret: Vec<u8>, port: u16, ws_port: u16) -> std::io::Result<()> {
+    let socket = UdpSocket::bind(("0.0.0.0", port)).await?;
+    let aes_key = derive_aes_key(&secret);
+    let mut suffix = ip_port_suffix(ws_port);
+    if suffix.is_none() {
+        crate::pylog!("⚠️ 暂时无法确定本机 IP，暂不应答发现请求");
+    }
+    let mut last_refresh = std::time::Instant::now();
+    let mut buf = [0u8; 1024];
+    loop {
+        let (len, addr) = socket.recv_from(&mut buf).await?;
+        // 与 Python 端一致：定期刷新本机 IP，兼容 DHCP 变更；
+        // 还没拿到 IP 时每个包都重试（connect 不会真的发包，开销很小）
+        if suffix.is_none() || last_refresh.elapsed().as_secs() >= 60 {
+            suffix = ip_port_suffix(ws_port);
+            last_refresh = std::time::Instant::now();
+        }
+        if len != 60 {
+            continue;
+        }
+        let timestamp = u64::from_be_bytes(buf[20..28].try_into().unwrap());
+        let now = SystemTime::now()
+            .duration_since(UNIX_EPOCH)
+            .unwrap_or_default()
+            .as_secs();
+        // 时间戳偏差超过 30 秒视为无效（防重放）
+        if now.abs_diff(timestamp) > 30 {
+            continue;
+        }
+        let version = buf[0];
+        if !mac_verify(version, &secret, &aes_key, &buf[..28], &buf[28..60]) {
+            continue;
+        }
+        // 没有确定的本机 IP 就不应答，绝不广播 0.0.0.0
+        let Some(suffix) = &suffix else {
+            continue;
+        };
+        let mut response = Vec::with_capacity(66);
+        response.extend_from_slice(&buf[..28]);
+        response.extend_from_slice(suffix);
+        let tag = mac_digest(version, &secret, &aes_key, &response);
+        response.extend_from_slice(&tag);
+        let _ = socket.send_to(&response, addr).await;
+    }
+}
+
+/// 应答包的后缀：本机 ip(4) + ws_port(2)，拿不到出口 IP 时返回 None
+fn ip_port_suffix(ws_port: u16) -> Option<[u8; 6]> {
+    let socket = std::net::UdpSocket::bind("0.0.0.0:0").ok()?;
+    // 不会真的发包，只是让内核选一个出口 IP
+    socket.connect("8.8.8.8:80").ok()?;
+    let std::net::SocketAddr::V4(addr) = socket.local_addr().ok()? else {
+        return None;
+    };
+    let octets = addr.ip().octets();
+    if octets == [0, 0, 0, 0] {
+        return None;
+    }
+    let mut suffix = [0u8; 6];
+    suffix[..4].copy_from_slice(&octets);
+    suffix[4..].copy_from_slice(&ws_port.to_be_bytes());
+    Some(suffix)
+}
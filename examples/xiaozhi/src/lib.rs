@@ -5,6 +5,7 @@ use pyo3::types::PyBytes;
 use serde_json::json;
 use server::AppServer;
 
+pub mod discovery;
 pub mod macros;
 pub mod python;
 pub mod server;
@@ -20,6 +21,27 @@ fn on_output_data(py: Python, data: Py<PyBytes>) -> PyResult<Bound<PyAny>> {
     })
 }
 
+#[pyfunction]
+fn hmac_sha256(py: Python, key: &[u8], msg: &[u8]) -> Py<PyBytes> {
+    use hmac::{Hmac, Mac};
+    use sha2::Sha256;
+    // sha2 会在运行时检测并启用 SHA-NI 硬件指令
+    let mut mac = Hmac::<Sha256>::new_from_slice(key).expect("HMAC 初始化失败");
+    mac.update(msg);
+    PyBytes::new(py, &mac.finalize().into_bytes()).into()
+}
+
+#[pyfunction]
+fn start_discovery(secret: Vec<u8>, port: u16, ws_port: u16) -> PyResult<()> {
+    // 监听循环跑在 tokio 的工作线程上，全程不持有 GIL
+    pyo3_async_runtimes::tokio::get_runtime().spawn(async move {
+        if let Err(e) = discovery::run(secret, port, ws_port).await {
+            crate::pylog!("❌ 服务发现异常: {}", e);
+        }
+    });
+    Ok(())
+}
+
 #[pyfunction]
 fn start_server(py: Python) -> PyResult<Bound<PyAny>> {
     pyo3_async_runtimes::tokio::future_into_py(py, async {
@@ -51,6 +73,8 @@ fn open_xiaoai_server(_py: Python, m: Bound<'_, PyModule>) -> PyResult<()> {
     m.add_function(wrap_pyfunction!(start_server, &m)?)?;
     m.add_function(wrap_pyfunction!(on_output_data, &m)?)?;
     m.add_function(wrap_pyfunction!(run_shell, &m)?)?;
+    m.add_function(wrap_pyfunction!(hmac_sha256, &m)?)?;
+    m.add_function(wrap_pyfunction!(start_discovery, &m)?)?;
     crate::python::init_module(&m)?;
     Ok(())
 }
@@ -0,0 +1,435 @@
+import ctypes
+import ctypes.util
+import errno
+import functools
+import hashlib
+import hmac
+import logging
+import logging.handlers
+import os
+import queue
+import selectors
+import socket
+import struct
+import sys
+import threading
+import time
+
+# 服务发现端口（区别于 stereo 组网使用的 53530）
+DISCOVERY_PORT = 53531
+
+# 小智服务的 WebSocket 端口（见 src/server.rs）
+WS_PORT = 4399
+
+# 发现协议的共享密钥（请修改成自己的，并与设备端保持一致）
+DEFAULT_SECRET = b"open-xiaoai"
+
+# 使用字符串形式的 digestmod，hashlib 会直接走 OpenSSL EVP，
+# 在支持 SHA 扩展指令的 CPU 上自动启用硬件加速
+_DIGEST = "sha256"
+assert _DIGEST in hashlib.algorithms_guaranteed
+
+# 优先使用 Rust 扩展里的 HMAC（sha2 运行时检测 SHA-NI），
+# 没编译扩展时退回 hashlib
+try:
+    from open_xiaoai_server import hmac_sha256 as _native_hmac
+except ImportError:
+    _native_hmac = None
+
+# Rust 扩展里的完整服务发现实现（tokio + ring 级别的 HMAC，全程不占 GIL），
+# 编译了扩展时整个监听循环都不再经过 Python
+try:
+    from open_xiaoai_server import start_discovery as _native_discovery
+except ImportError:
+    _native_discovery = None
+
+# （可选）AES-128-CMAC 模式：老 CPU 普遍没有 SHA 扩展但都有 AES-NI，
+# 依赖 cryptography（底层走 OpenSSL EVP），未安装时只支持 HMAC。
+# 安装方式：uv sync --extra cmac（见 pyproject.toml）
+try:
+    from cryptography.hazmat.primitives.ciphers import algorithms as _aes_algorithms
+    from cryptography.hazmat.primitives.cmac import CMAC as _CMAC
+except ImportError:
+    _CMAC = None
+
+# device_id 首字节为协议版本，决定 MAC 算法（向后兼容：其余值均视为 HMAC）
+MAC_HMAC_SHA256 = 0x01
+MAC_AES_CMAC = 0x02
+
+# 预编译的时间戳解析器，免去每个包重新解析格式串
+_TS_STRUCT = struct.Struct(">Q")
+
+# 时间戳偏差超过 30 秒视为无效（防重放）
+_WINDOW_NS = 30 * 10**9
+
+# 热路径的日志只入队，格式化和 write(2) 由后台线程完成；
+# 日志级别高于 DEBUG 时，每个包的日志调用会被直接短路掉
+_logger = logging.getLogger(__name__)
+_log_listener = None
+
+
+def _setup_logging():
+    global _log_listener
+    if _log_listener is not None:
+        return
+    log_queue = queue.SimpleQueue()
+    _logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    _log_listener = logging.handlers.QueueListener(
+        log_queue, logging.StreamHandler()
+    )
+    _log_listener.start()
+
+# 每次 recvmmsg 最多取走的包数 / 单个包的缓冲区大小
+_BATCH_SIZE = 32
+_PACKET_SIZE = 1024
+
+# Linux 下绑定 recvmmsg(2)，一次系统调用取走整个突发
+_libc = None
+if sys.platform == "linux":
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        _libc.recvmmsg
+    except (OSError, AttributeError):
+        _libc = None
+
+_MSG_WAITFORONE = 0x10000
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t),
+    ]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", _msghdr),
+        ("msg_len", ctypes.c_uint),
+    ]
+
+
+class _BatchReceiver:
+    """
+    基于 recvmmsg(2) 的批量接收器。
+
+    预分配好接收缓冲区和 mmsghdr 数组，每次唤醒用一次系统调用
+    取走最多 _BATCH_SIZE 个包，摊薄高压下的 syscall 开销。
+    """
+
+    def __init__(self, sock):
+        self.fd = sock.fileno()
+        self._bufs = [ctypes.create_string_buffer(_PACKET_SIZE) for _ in range(_BATCH_SIZE)]
+        # 复用缓冲区的零拷贝视图，下一次 recv() 前数据保持有效
+        self._views = [memoryview(buf).cast("B") for buf in self._bufs]
+        self._names = [ctypes.create_string_buffer(16) for _ in range(_BATCH_SIZE)]
+        self._iovs = (_iovec * _BATCH_SIZE)()
+        self._hdrs = (_mmsghdr * _BATCH_SIZE)()
+        for i in range(_BATCH_SIZE):
+            self._iovs[i].iov_base = ctypes.cast(self._bufs[i], ctypes.c_void_p)
+            self._iovs[i].iov_len = _PACKET_SIZE
+            hdr = self._hdrs[i].msg_hdr
+            hdr.msg_name = ctypes.cast(self._names[i], ctypes.c_void_p)
+            hdr.msg_namelen = 16
+            hdr.msg_iov = ctypes.pointer(self._iovs[i])
+            hdr.msg_iovlen = 1
+
+    def recv(self):
+        """阻塞等待，返回 [(data, addr), ...]"""
+        for i in range(_BATCH_SIZE):
+            self._hdrs[i].msg_hdr.msg_namelen = 16
+        while True:
+            count = _libc.recvmmsg(
+                self.fd, self._hdrs, _BATCH_SIZE, _MSG_WAITFORONE, None
+            )
+            if count >= 0:
+                break
+            err = ctypes.get_errno()
+            # ctypes 调用没有 PEP 475 的 EINTR 自动重试，信号打断后要自己重来
+            if err == errno.EINTR:
+                continue
+            # 非阻塞模式下队列空了就交还控制权
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            raise OSError(err, os.strerror(err))
+        packets = []
+        for i in range(count):
+            data = self._views[i][: self._hdrs[i].msg_len]
+            name = self._names[i].raw
+            # sockaddr_in: family(2) + port(2, 大端) + ip(4)
+            addr = (socket.inet_ntoa(name[4:8]), (name[2] << 8) | name[3])
+            packets.append((data, addr))
+        return packets
+
+
+class DiscoveryService:
+    """
+    UDP 服务发现：设备在局域网内广播发现请求，
+    服务端校验 HMAC 后应答自己的 IP 和 WebSocket 端口。
+
+    请求包（60 字节）: device_id(16) + nonce(4) + timestamp(8) + mac(32)
+    应答包（66 字节）: 请求前 28 字节 + ip(4) + ws_port(2) + mac(32)
+
+    device_id 的首字节是协议版本，用于选择 MAC 算法
+    （0x02 = AES-128-CMAC，其余 = HMAC-SHA256）。
+    """
+
+    def __init__(
+        self, secret=DEFAULT_SECRET, port=DISCOVERY_PORT, ws_port=WS_PORT, workers=None
+    ):
+        self.secret = secret
+        self.port = port
+        self.ws_port = ws_port
+        self.workers = workers
+        self.socket = None
+        self.running = False
+        self._sockets = []
+        # 校验函数在初始化时特化（见 _make_validator）
+        self._validate_packet = self._make_validator()
+        # 预先吸收 ipad / opad 的 SHA-256 状态，
+        # 每个包只需 .copy() 一次，省去两个 64 字节块的压缩
+        key = secret if len(secret) <= 64 else hashlib.sha256(secret).digest()
+        key = key.ljust(64, b"\x00")
+        self._inner = hashlib.new(_DIGEST, bytes(b ^ 0x36 for b in key))
+        self._outer = hashlib.new(_DIGEST, bytes(b ^ 0x5C for b in key))
+        # CMAC 模式用的 16 字节 AES 密钥，从 secret 单步派生（HKDF-Expand）
+        self._aes_key = hmac.new(secret, b"open-xiaoai-cmac", hashlib.sha256).digest()[:16]
+        # 缓存本机 IP（4 字节大端），避免每个包都做一次阻塞的解析；
+        # 暂时拿不到可用 IP 时后缀为 None，拿到之前不应答（见 _refresh_ip）
+        self._ip_bytes = self._resolve_ip()
+        # 应答包的后缀：ip(4) + ws_port(2)
+        self._ip_port_suffix = None
+        if self._ip_bytes is None:
+            print("⚠️ 暂时无法确定本机 IP，暂不应答发现请求")
+        else:
+            self._ip_port_suffix = self._ip_bytes + struct.pack(">H", self.ws_port)
+        # 以完整请求为 key 缓存应答：重放的合法请求直接命中，
+        # 整个 MAC 校验 + 签名都被省掉（容量有上限，不怕灌爆）
+        self._respond = functools.lru_cache(maxsize=4096)(self._verify_and_build)
+
+    @staticmethod
+    def _resolve_ip():
+        """解析本机的出口 IP，拿不到可用地址时返回 None
+
+        和 src/discovery.rs 一样用 UDP connect 让内核选出口 IP
+        （不会真的发包）；gethostbyname(gethostname()) 在很多主机上
+        解析到回环地址，对局域网客户端没有意义。
+        """
+        try:
+            probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                probe.connect(("8.8.8.8", 80))
+                ip = probe.getsockname()[0]
+            finally:
+                probe.close()
+        except OSError:
+            return None
+        if ip == "0.0.0.0" or ip.startswith("127."):
+            return None
+        return socket.inet_aton(ip)
+
+    def _refresh_ip(self):
+        # 定期刷新本机 IP，兼容 DHCP 变更；
+        # 和 Rust 版一样，还没拿到可用 IP 时更快地重试，网络就绪后尽快应答
+        while self.running:
+            time.sleep(5 if self._ip_port_suffix is None else 60)
+            ip_bytes = self._resolve_ip()
+            if ip_bytes != self._ip_bytes:
+                self._ip_bytes = ip_bytes
+                if ip_bytes is None:
+                    self._ip_port_suffix = None
+                else:
+                    self._ip_port_suffix = ip_bytes + struct.pack(">H", self.ws_port)
+                # IP 变了，缓存的应答全部失效
+                self._respond.cache_clear()
+
+    def _cmac_digest(self, msg):
+        cmac = _CMAC(_aes_algorithms.AES(self._aes_key))
+        cmac.update(bytes(msg))
+        # 16 字节 tag 补零到 32 字节，保持线上格式不变
+        return cmac.finalize().ljust(32, b"\x00")
+
+    def _mac_digest(self, version, msg):
+        if version == MAC_AES_CMAC:
+            return self._cmac_digest(msg)
+        return self._hmac_digest(msg)
+
+    def _hmac_digest(self, msg):
+        if _native_hmac is not None:
+            return _native_hmac(self.secret, bytes(msg))
+        h = self._inner.copy()
+        h.update(msg)
+        o = self._outer.copy()
+        o.update(h.digest())
+        return o.digest()
+
+    def _worker_count(self):
+        # SO_REUSEPORT 让内核按流哈希把包分摊到各监听 socket。
+        # 带 GIL 时多线程也能摊薄内核侧的收包队列；
+        # 自由线程（PEP 703）构建下各线程更是真正并行
+        if not hasattr(socket, "SO_REUSEPORT"):
+            return 1
+        if self.workers:
+            return self.workers
+        return os.cpu_count() or 1
+
+    def _open_socket(self, reuse_port=False):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # 加大接收缓冲区，突发流量下不易丢包
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        sock.bind(("0.0.0.0", self.port))
+        if hasattr(socket, "SO_BUSY_POLL"):
+            # 让内核在 NAPI 层忙等 50 微秒再睡眠，降低唤醒延迟（空闲时零开销）
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_BUSY_POLL, 50)
+            except OSError:
+                pass
+        return sock
+
+    def start(self):
+        """启动服务发现"""
+        if _native_discovery is not None and self.port:
+            # Rust 版监听循环：socket 由 tokio 持有，Python 侧零开销
+            _native_discovery(self.secret, self.port, self.ws_port)
+            print(f"✅ 服务发现已启动: 0.0.0.0:{self.port} (native)")
+            return
+        _setup_logging()
+        self.running = True
+        workers = self._worker_count()
+        for _ in range(workers):
+            sock = self._open_socket(reuse_port=workers > 1)
+            # 绑定 port=0 时由首个 socket 确定实际端口，其余 socket 复用
+            self.port = sock.getsockname()[1]
+            self._sockets.append(sock)
+            threading.Thread(target=self._listen, args=(sock,), daemon=True).start()
+        self.socket = self._sockets[0]
+        threading.Thread(target=self._refresh_ip, daemon=True).start()
+        print(f"✅ 服务发现已启动: 0.0.0.0:{self.port} x{workers}")
+
+    def stop(self):
+        """停止服务发现"""
+        self.running = False
+        for sock in self._sockets:
+            sock.close()
+        self._sockets = []
+        self.socket = None
+
+    def _listen(self, sock):
+        if _libc is not None:
+            try:
+                self._listen_batch(sock)
+                return
+            except OSError as e:
+                if e.errno != errno.ENOSYS:
+                    # 正常停机时 socket 被关掉属于预期，其余情况必须留痕
+                    if self.running:
+                        _logger.error("❌ 服务发现监听异常: %s", e)
+                    return
+        self._listen_drain(sock)
+
+    def _listen_batch(self, sock):
+        # 和 _listen_drain 一样先等可读再收：带超时的 select 让线程
+        # 能周期性检查 self.running，stop() 关闭 socket 后不会有线程
+        # 永远卡在 recvmmsg 里
+        receiver = _BatchReceiver(sock)
+        sock.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(sock, selectors.EVENT_READ)
+        try:
+            while self.running:
+                if not selector.select(timeout=1):
+                    continue
+                packets = receiver.recv()
+                # 整个突发共用一次取时，省掉 N-1 次 clock_gettime
+                now_ns = time.time_ns()
+                for data, addr in packets:
+                    self._handle_packet(sock, data, addr, now_ns)
+        finally:
+            selector.close()
+
+    def _listen_drain(self, sock):
+        # recvmmsg 不可用时的兜底：epoll 唤醒后以非阻塞方式把 socket 清空，
+        # 一次唤醒处理整个突发，而不是每个包一次 select + recvfrom
+        sock.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(sock, selectors.EVENT_READ)
+        try:
+            while self.running:
+                if not selector.select(timeout=1):
+                    continue
+                now_ns = time.time_ns()
+                while True:
+                    try:
+                        data, addr = sock.recvfrom(_PACKET_SIZE)
+                    except BlockingIOError:
+                        break
+                    self._handle_packet(sock, data, addr, now_ns)
+        except OSError:
+            pass
+        finally:
+            selector.close()
+
+    def _handle_packet(self, sock, data, addr, now_ns=None):
+        if not self._validate_packet(data, now_ns):
+            return
+        response = self._respond(bytes(data))
+        if response is None:
+            return
+        try:
+            sock.sendto(response, addr)
+        except BlockingIOError:
+            # 发送缓冲区满时直接丢弃，设备端会重试
+            return
+        _logger.debug("🔥 发现请求: %s", addr[0])
+
+    def _make_validator(self):
+        # 把校验要用到的属性 / 全局引用固化成闭包局部变量，
+        # 省掉每个包若干次 CPython 字典查找（布局在启动后不再变化）
+        unpack_ts = _TS_STRUCT.unpack_from
+        window_ns = _WINDOW_NS
+        second_ns = 10**9
+        time_ns = time.time_ns
+        cmac_version = MAC_AES_CMAC
+        cmac_ready = _CMAC is not None
+
+        def validate(data, now_ns=None):
+            if len(data) != 60:
+                return False
+            if now_ns is None:
+                now_ns = time_ns()
+            # 纯整数比较，不经过浮点的 time.time() / abs()
+            if abs(now_ns - unpack_ts(data, 20)[0] * second_ns) > window_ns:
+                return False
+            # MAC 校验在 _verify_and_build 里做（结果会进应答缓存）
+            return data[0] != cmac_version or cmac_ready
+
+        return validate
+
+    def _verify_and_build(self, request: bytes):
+        """校验 MAC 并构造应答，结果（包括 None = 校验失败）由 lru_cache 缓存"""
+        if not hmac.compare_digest(
+            self._mac_digest(request[0], request[:28]), request[28:]
+        ):
+            return None
+        # 还没拿到可用的本机 IP 就不应答，绝不签名广播回环地址；
+        # IP 就位 / 变更时 _refresh_ip 会清空缓存，这里缓存 None 无妨
+        suffix = self._ip_port_suffix
+        if suffix is None:
+            return None
+        response = request[:28] + suffix
+        return response + bytes(self._mac_digest(request[0], response))